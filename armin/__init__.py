@@ -0,0 +1 @@
+from armin import _threading  # noqa: F401
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 Alberto Pérez García-Plaza
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Alberto Pérez García-Plaza <alberto.perez@lsi.uned.es>
+#
+import contextlib
+import os
+
+
+def available_cpus():
+    """Number of CPUs the current process is allowed to run on."""
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is not available on every platform
+        return os.cpu_count() or 1
+
+
+# Variables sizing the thread pools of OpenMP, MKL and OpenBLAS
+THREAD_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+# Tokenizers read this variable when they are first used, so it is
+# set as soon as the package is imported. A value given by the user
+# takes precedence
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
+
+def configure_torch_threads():
+    """Size PyTorch thread pools: one intra-op thread per available
+    CPU, unless `OMP_NUM_THREADS` says otherwise, and a single inter-op
+    thread, so independent operations do not oversubscribe the CPUs.
+
+    Only PyTorch is configured. Thread variables are not exported to the
+    environment, since worker processes rely on them being unset to size
+    their own thread pools."""
+
+    import torch
+
+    if "OMP_NUM_THREADS" not in os.environ:
+        torch.set_num_threads(available_cpus())
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # It can only be set before any inter-op parallel work starts
+        pass
+
+
+@contextlib.contextmanager
+def worker_threads(n_workers):
+    """Split the available CPUs among worker processes started within
+    the context, so each one runs `available_cpus() // n_workers` threads
+    instead of one per CPU. Thread variables given by the user are kept,
+    and the environment is restored when leaving the context.
+
+    :param n_workers: number of worker processes
+    """
+    n_threads = str(max(1, available_cpus() // n_workers))
+    unset = [var for var in THREAD_VARS if var not in os.environ]
+    for var in unset:
+        os.environ[var] = n_threads
+    try:
+        yield
+    finally:
+        for var in unset:
+            os.environ.pop(var, None)
@@ -18,10 +18,10 @@
 # Authors:
 #     Alberto Pérez García-Plaza <alberto.perez@lsi.uned.es>
 #
-import json
 import os
 
 from .errors import DatasetError, ResultsError
+from .utils import load_json
 
 
 class NLI4CTEvaluator:
@@ -39,8 +39,7 @@ class NLI4CTEvaluator:
             raise DatasetError(cause="Dataset file %s does not exist" % gold_path)
 
         # Load gold dataset
-        with open(gold_path) as gold_file:
-            self.gold = json.load(gold_file)
+        self.gold = load_json(gold_path)
 
     def evaluate(self, results_path):
         """Evaluates results against the gold standard
@@ -55,20 +54,20 @@ class NLI4CTEvaluator:
             raise ResultsError(cause="Results file %s does not exist" % results_path)
 
         # Load results fle
-        with open(results_path) as results_file:
-            results = json.load(results_file)
+        results = load_json(results_path)
 
         results_p = []
         gold_p = []
         results_s = []
         gold_s = []
 
-        for uuid in results.keys():
-            gold_p.append(self.gold[uuid]["Primary_evidence_index"])
-            results_p.append(results[uuid]["Primary_evidence_index"])
-            if self.gold[uuid]["Type"] == "Comparison":
-                gold_s.append(self.gold[uuid]["Secondary_evidence_index"])
-                results_s.append(results[uuid]["Secondary_evidence_index"])
+        for uuid, result in results.items():
+            gold = self.gold[uuid]
+            gold_p.append(gold["Primary_evidence_index"])
+            results_p.append(result["Primary_evidence_index"])
+            if gold["Type"] == "Comparison":
+                gold_s.append(gold["Secondary_evidence_index"])
+                results_s.append(result["Secondary_evidence_index"])
 
         tp_p, fp_p, fn_p = self.__compare(results_p, gold_p)
         tp_s, fp_s, fn_s = self.__compare(results_s, gold_s)
@@ -99,14 +98,12 @@ class NLI4CTEvaluator:
         tp = 0
         fp = 0
         fn = 0
-        for i in range(len(gold_ev)):
-            for j in range(len(results_ev[i])):
-                if results_ev[i][j] in gold_ev[i]:
-                    tp += 1
-                if results_ev[i][j] not in gold_ev[i]:
-                    fp += 1
-            for j in range(len(gold_ev[i])):
-                if gold_ev[i][j] not in results_ev[i]:
-                    fn += 1
+        for results_idx, gold_idx in zip(results_ev, gold_ev):
+            results_idx = set(results_idx)
+            gold_idx = set(gold_idx)
+            hits = len(results_idx & gold_idx)
+            tp += hits
+            fp += len(results_idx) - hits
+            fn += len(gold_idx) - hits
 
         return tp, fp, fn
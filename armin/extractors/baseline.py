@@ -18,16 +18,44 @@
 # Authors:
 #     Alberto Pérez García-Plaza <alberto.perez@lsi.uned.es>
 #
-import datetime
-import json
+import functools
 import os
-import time
+import re
 
-from nltk import RegexpTokenizer
+import bm25s
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
 from nltk.corpus import stopwords
-from rank_bm25 import BM25Okapi
+from scipy import sparse
+from tqdm import tqdm
 
 from armin.errors import CTRError, DatasetError
+from armin.utils import load_json
+
+# BM25 parameters, the same BM25Okapi from rank_bm25 uses by default
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+
+# Tokens are sequences of word characters and apostrophes
+TOKEN_RE = re.compile(r"[\w']+")
+
+# Extractor searching CTR sections within a worker process
+_worker_extractor = None
+
+
+def _init_worker(extractor):
+    """Set up a worker process. The extractor is shipped once per worker
+    rather than once per task, and keeps its caches between tasks."""
+
+    global _worker_extractor
+    _worker_extractor = extractor
+
+
+def _retrieve_group_evidences_in_worker(ctr_id, section_id, entries):
+    return _worker_extractor._retrieve_group_evidences(ctr_id,
+                                                       section_id,
+                                                       entries)
 
 
 class CTRReader:
@@ -39,12 +67,41 @@ class CTRReader:
 
         self.ctrs_folder_path = ctrs_folder_path
 
+        self._init_caches()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_load_ctr", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_caches()
+
+    def _init_caches(self):
+        """Set up the cache of parsed CTR files. Each reader keeps its
+        own one, which is not pickled along with it."""
+
+        # Files are parsed only once, since the same CTR is read for
+        # many statements
+        self._load_ctr = functools.lru_cache(maxsize=None)(self._load_ctr)
+
     def read_section(self, ctr_id, section_id):
         """ Reads a CTR section given their identifiers
 
         :param ctr_id: CTR identifier
         :param section_id: identifier of the CTR section to read
 
+        :raises CTRError: when the CTR file does not exist or is not
+        valid
+        """
+        return self._load_ctr(ctr_id)[section_id]
+
+    def _load_ctr(self, ctr_id):
+        """ Loads a CTR file given its identifier.
+
+        :param ctr_id: CTR identifier
+
         :raises CTRError: when the CTR file does not exist or is not
         valid
         """
@@ -53,10 +110,7 @@ class CTRReader:
         if not os.path.exists(ctr_path):
             raise CTRError(cause="CTRS file %s does not exist" % ctr_path)
 
-        with open(ctr_path) as ctr_file:
-            ctr = json.load(ctr_file)
-
-        return ctr[section_id]
+        return load_json(ctr_path)
 
 
 class Baseline:
@@ -73,6 +127,10 @@ class Baseline:
         valid
     """
 
+    # Attributes holding caches, which are not pickled along with
+    # the extractor
+    _cache_attrs = ("_section_indexes", "tokenize")
+
     def __init__(self, dataset_path, ctrs_folder_path):
 
         if not os.path.exists(dataset_path):
@@ -82,17 +140,38 @@ class Baseline:
         self._crt_reader = CTRReader(ctrs_folder_path)
 
         # Load dataset
-        with open(dataset_path) as dataset_file:
-            self.dataset = json.load(dataset_file)
-
-        self._tokenizer = RegexpTokenizer(r"[\w']+")
+        self.dataset = load_json(dataset_path)
 
         try:
-            self._stops_en = set(stopwords.words('english'))
+            self._stops_en = frozenset(stopwords.words('english'))
         except LookupError:
             import nltk
             nltk.download('stopwords')
-            self._stops_en = set(stopwords.words('english'))
+            self._stops_en = frozenset(stopwords.words('english'))
+
+        self._init_caches()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in self._cache_attrs:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_caches()
+
+    def _init_caches(self):
+        """Set up the caches of the extractor. Caches are not pickled,
+        so each process running the extractor builds its own ones."""
+
+        # Indexes of the CTR sections already read, so they are built
+        # only once no matter how many statements refer to them
+        self._section_indexes = {}
+
+        # The same sentences show up in many CTRs and statements, so
+        # keep the tokens of the most recent ones around
+        self.tokenize = functools.lru_cache(maxsize=100_000)(self.tokenize)
 
     def tokenize(self, text):
         """ Tokenize a text
@@ -104,84 +183,237 @@ class Baseline:
         # tokenized = [[x.strip(' ') for x in y] for y in tokenized]
         # tokenized = [[x for x in y if x] for y in tokenized]
 
-        tokens = self._tokenizer.tokenize(text.lower())
-
         # Remove stopwords from text using nltk stopwords
-        tokens = [t for t in tokens if t not in self._stops_en]
+        stops = self._stops_en
+        tokens = [t for t in TOKEN_RE.findall(text.lower())
+                  if t not in stops]
 
         return tokens
 
-    def _retrieve_section_evidences(self, statement_tokens, section):
-        """Search evidences for the given statement within the
-         given section.
+    def _index_section(self, section):
+        """Builds the index used to search evidences within a section.
 
-        :param statement_tokens: statement tokens to be used as query to look
-            for evidences
-        :param section: CTR section to extract evidences from
+        :param section: CTR section to be indexed
 
-        :return: list of indexes of those sentences in the section
-            considered as evidences for the given statement
+        :return: a tuple with the vocabulary of the section, mapping
+            each token to its row in the score matrix, and a sparse
+            matrix with the BM25 score of each token (rows) for each
+            sentence (columns) in the section
         """
         # create an instance of the BM25 class, which reads in the
-        # section tokenized text and does some indexing on it
+        # section tokenized text and does some indexing on it.
+        # Robertson's variant is the one implemented by rank_bm25's
+        # BM25Okapi, which this extractor used to rely on
         tokenized = [self.tokenize(sent) for sent in section]
-        bm25 = BM25Okapi(tokenized)
-        # Retrieve bm25 scores for the primary section using
-        # the tokenized statement as a query
-        scores = bm25.get_scores(statement_tokens)
-        # Retrieve all entries from the primary section with a bm25
+        bm25 = bm25s.BM25(k1=BM25_K1, b=BM25_B, method="robertson")
+        bm25.index(tokenized, show_progress=False)
+
+        # bm25s computes every token score beforehand. Lay them out
+        # as a matrix, so scoring a query is a single compiled
+        # vector-matrix product instead of a Python loop over its tokens.
+        # bm25s leaves out the (k1 + 1) factor of the term frequency
+        # component; fold it in here so scores keep BM25Okapi's scale
+        # and queries do not need to rescale them
+        scores = bm25.scores
+        matrix = sparse.csr_matrix(
+                (scores["data"] * (BM25_K1 + 1),
+                 scores["indices"],
+                 scores["indptr"]),
+                shape=(len(scores["indptr"]) - 1, scores["num_docs"]))
+        matrix = self._floor_idfs(tokenized, bm25.vocab_dict, matrix)
+
+        return bm25.vocab_dict, matrix
+
+    @staticmethod
+    def _floor_idfs(tokenized, vocab, matrix):
+        """Applies BM25Okapi's floor to the IDF of the tokens found in
+        more than half of the sentences.
+
+        The IDF of those tokens is negative. BM25Okapi raises it to
+        `BM25_EPSILON` times the average IDF of the section, whereas
+        bm25s zeroes it, so their scores are recomputed here to keep
+        evidences the same as BM25Okapi ones.
+
+        :param tokenized: list with the tokens of each sentence
+        :param vocab: vocabulary of the section, mapping each token to
+            its row in the score matrix
+        :param matrix: score matrix as built by bm25s
+
+        :return: the score matrix with the floored IDFs
+        """
+        n_rows, n_docs = matrix.shape
+        ids = [vocab[t] for sent_tokens in tokenized for t in sent_tokens]
+        if not ids:
+            return matrix
+
+        # Term frequency of each token (rows) in each sentence (columns)
+        doc_lens = np.array([len(sent_tokens) for sent_tokens in tokenized])
+        tf = sparse.csr_matrix(
+                (np.ones(len(ids)),
+                 (ids, np.repeat(np.arange(n_docs), doc_lens))),
+                shape=(n_rows, n_docs))
+        tf.sum_duplicates()
+
+        doc_freqs = np.diff(tf.indptr)
+        present = doc_freqs > 0
+        idf = np.log(n_docs - doc_freqs + 0.5) - np.log(doc_freqs + 0.5)
+        floored = present & (idf < 0)
+        if not floored.any():
+            return matrix
+        eps = BM25_EPSILON * idf[present].mean()
+
+        # Term frequency component of the score, (k1 + 1) factor included
+        norms = BM25_K1 * (1 - BM25_B
+                           + BM25_B * doc_lens / doc_lens.mean())
+        tf.data = tf.data * (BM25_K1 + 1) \
+            / (tf.data + norms[tf.indices])
+
+        return (sparse.diags((~floored).astype(float)) @ matrix
+                + sparse.diags(np.where(floored, eps, 0.)) @ tf).tocsr()
+
+    def _section_index(self, ctr_id, section_id):
+        """Returns the index of a CTR section, reading and indexing
+        the section the first time it is requested.
+
+        :param ctr_id: CTR identifier
+        :param section_id: identifier of the CTR section
+
+        :return: index of the section as built by `_index_section`
+        """
+        key = (ctr_id, section_id)
+        if key not in self._section_indexes:
+            section = self._crt_reader.read_section(ctr_id, section_id)
+            self._section_indexes[key] = self._index_section(section)
+
+        return self._section_indexes[key]
+
+    def _retrieve_section_evidences(self, statements_tokens, section_index):
+        """Search evidences for a group of statements within the
+         given section.
+
+        :param statements_tokens: list with the tokens of each statement,
+            to be used as queries to look for evidences
+        :param section_index: index of the CTR section to extract evidences
+            from, as built by `_index_section`
+
+        :return: list with the indexes of those sentences in the section
+            considered as evidences for each statement
+        """
+        vocab, matrix = section_index
+
+        # Count how many times each token of the section shows up in
+        # each statement; unknown tokens do not add anything to the score
+        rows = []
+        cols = []
+        for row, statement_tokens in enumerate(statements_tokens):
+            for t in statement_tokens:
+                if t in vocab:
+                    rows.append(row)
+                    cols.append(vocab[t])
+        queries = sparse.csr_matrix(
+                (np.ones(len(rows)), (rows, cols)),
+                shape=(len(statements_tokens), matrix.shape[0]))
+
+        # Retrieve bm25 scores for the section using the tokenized
+        # statements as queries, all of them at once
+        scores = (queries @ matrix).toarray()
+        # Retrieve all entries from the section with a bm25
         # score over 1
-        section_evidences = [i for i in range(len(scores))
-                             if scores[i] > 1]
+        section_evidences = [np.flatnonzero(st_scores > 1).tolist()
+                             for st_scores in scores]
 
         return section_evidences
 
-    def retrieve_evidences(self):
+    def _group_by_section(self):
+        """Groups the statements in the dataset by the CTR section
+        their evidences have to be retrieved from.
+
+        :return: a dict mapping each (CTR identifier, section identifier)
+            pair to the list of (uuid, evidence key) pairs referring to
+            it, where the evidence key is either "Primary_evidence_index"
+            or "Secondary_evidence_index"
+        """
+        groups = {}
+        for uuid, ps_info in self.dataset.items():
+            key = (ps_info["Primary_id"], ps_info["Section_id"])
+            groups.setdefault(key, []).append(
+                    (uuid, "Primary_evidence_index"))
+
+            if ps_info["Type"] == "Comparison":
+                key = (ps_info["Secondary_id"], ps_info["Section_id"])
+                groups.setdefault(key, []).append(
+                        (uuid, "Secondary_evidence_index"))
+
+        return groups
+
+    def _retrieve_group_evidences(self, ctr_id, section_id, entries):
+        """Search evidences within a CTR section for a group of
+        statements.
+
+        :param ctr_id: CTR identifier
+        :param section_id: identifier of the CTR section
+        :param entries: list of (uuid, evidence key) pairs of the
+            statements to search evidences for, as grouped by
+            `_group_by_section`
+
+        :return: a dict mapping each (uuid, evidence key) pair to the
+            list of indexes of the evidences found in the section
+        """
+        section_index = self._section_index(ctr_id, section_id)
+
+        statements_tokens = [self.tokenize(self.dataset[uuid]["Statement"])
+                             for uuid, _ in entries]
+        section_evidences = \
+            self._retrieve_section_evidences(statements_tokens,
+                                             section_index)
+
+        return dict(zip(entries, section_evidences))
+
+    def retrieve_evidences(self, n_jobs=1):
         """Retrieve evidences for each statement in the dataset from the
         corresponding CTR files and sections.
 
+        Statements are processed grouped by the CTR section they refer
+        to, so each section is searched by all its statements in a row.
+
+        :param n_jobs: number of processes used to search the CTR
+            sections, -1 to use all CPUs. Defaults to 1, which runs
+            everything within the current process
+
         :return: a dict with the primary and secondary (when applies)
             evidences retrieved from the CTRs. Evidences are represented
             as a list of indexes of each sentence considered as evidence
             for the given statement.
         """
-        total = len(self.dataset.keys())
-        completed = 0
-        start = time.perf_counter()
-        elapsed = 0
+        groups = self._group_by_section()
+        evidences = {}
+        if effective_n_jobs(n_jobs) == 1:
+            group_evidences = (
+                self._retrieve_group_evidences(ctr_id, section_id, entries)
+                for (ctr_id, section_id), entries in groups.items())
+        else:
+            # Tasks only carry the group to search, workers get the
+            # extractor when they start
+            tasks = (delayed(_retrieve_group_evidences_in_worker)(
+                        ctr_id, section_id, entries)
+                     for (ctr_id, section_id), entries in groups.items())
+            group_evidences = Parallel(n_jobs=n_jobs,
+                                       return_as="generator",
+                                       initializer=_init_worker,
+                                       initargs=(self,))(tasks)
+        for group_ev in tqdm(group_evidences, total=len(groups),
+                             unit="section"):
+            evidences.update(group_ev)
+
+        # Rebuild the results following the dataset order
         results = {}
-        for uuid in self.dataset.keys():
-            ps_info = self.dataset[uuid]
-            statement_tokens = self.tokenize(ps_info["Statement"])
-            primary_section = \
-                self._crt_reader.read_section(ps_info["Primary_id"],
-                                              ps_info["Section_id"])
-
-            primary_evidences = self._retrieve_section_evidences(
-                    statement_tokens,
-                    primary_section)
-            results[uuid] = {"Primary_evidence_index": primary_evidences}
-
-            # Repeat for the secondary trial
+        for uuid, ps_info in self.dataset.items():
+            results[uuid] = {
+                "Primary_evidence_index":
+                    evidences[uuid, "Primary_evidence_index"]
+            }
             if ps_info["Type"] == "Comparison":
-                secondary_section = self._crt_reader.read_section(
-                        ps_info["Secondary_id"],
-                        ps_info["Section_id"])
-
-                secondary_evidences = self._retrieve_section_evidences(
-                        statement_tokens,
-                        secondary_section)
-                results[uuid]["Secondary_evidence_index"] = secondary_evidences
-
-            completed += 1
-            end = time.perf_counter()
-            elapsed = (end - start)
-            estimated = (1 / (completed / total)) * elapsed
-            print(f"\r[{uuid}] Completion: {completed}/{total} "
-                  f"Elapsed: {datetime.timedelta(seconds=round(elapsed))} - "
-                  f"Estimated: {datetime.timedelta(seconds=round(estimated))}",
-                  end='')
-
-        print(f"\rCompletion: {completed}/{total} "
-              f"Elapsed: {datetime.timedelta(seconds=round(elapsed))}")
+                results[uuid]["Secondary_evidence_index"] = \
+                    evidences[uuid, "Secondary_evidence_index"]
+
         return results
@@ -18,7 +18,10 @@
 # Authors:
 #     Alberto Pérez García-Plaza <alberto.perez@lsi.uned.es>
 #
+import bisect
+import functools
 
+import numpy as np
 from ontobio import OntologyFactory
 
 from armin.extractors.baseline import Baseline
@@ -39,6 +42,8 @@ class OntobioSim(Baseline):
             valid
         """
 
+    _cache_attrs = Baseline._cache_attrs + ("_search",)
+
     def __init__(self, dataset_path, ctrs_folder_path, threshold=.2):
         super().__init__(dataset_path, ctrs_folder_path)
 
@@ -52,47 +57,132 @@ class OntobioSim(Baseline):
         self.__ont = o_factory.create('go')
         print("Done!")
 
-    def _retrieve_section_evidences(self, statement_tokens, section):
+        # Searching the ontology scans the label of every node in
+        # Python for each term. Join all labels in a single text
+        # instead, so terms are looked up by a native substring search
+        print("Indexing ontology labels...", end='')
+        labels = []
+        self._label_ids = []
+        self._label_offsets = []
+        offset = 0
+        for node_id in self.__ont.nodes():
+            label = self.__ont.label(node_id)
+            if not label:
+                continue
+            labels.append(label.replace("\n", " "))
+            self._label_ids.append(node_id)
+            self._label_offsets.append(offset)
+            offset += len(label) + 1
+        self._labels = "\n".join(labels)
+        print("Done!")
+
+    def _init_caches(self):
+        super()._init_caches()
+
+        # The same terms are looked up over and over
+        self._search = functools.lru_cache(maxsize=None)(self._search)
+
+    def _search(self, term):
+        """Search the ontology nodes whose label contains the given
+        term. Equivalent to ``search(term + '%')`` on the ontology for
+        terms with no regular expression special characters, as it is
+        the case for the tokens produced by `tokenize`.
+
+        :param term: term to look for
+
+        :return: frozenset of identifiers of the matching nodes
+        """
+        ids = []
+        pos = self._labels.find(term)
+        while pos != -1:
+            node = bisect.bisect_right(self._label_offsets, pos) - 1
+            ids.append(self._label_ids[node])
+            # Move on to the next label, this one already matched
+            if node + 1 < len(self._label_offsets):
+                pos = self._labels.find(term, self._label_offsets[node + 1])
+            else:
+                pos = -1
+
+        return frozenset(ids)
+
+    def _find_entities(self, tokens):
+        """Find the ontology entities mentioned in a list of tokens.
+
+        :param tokens: tokens to look for in the ontology
+
+        :return: a tuple with the set of entities found and the number
+            of matches, where an entity counts once per token matching it
+        """
+        entities = set()
+        matches = 0
+        for term in tokens:
+            ids = self._search(term)
+            entities.update(ids)
+            matches += len(ids)
+
+        return entities, matches
+
+    def _index_section(self, section):
+        """Find the ontology entities mentioned in each sentence of a
+        section.
+
+        :param section: CTR section to be indexed
+
+        :return: list with the entities found in each sentence of the
+            section, as returned by `_find_entities`
+        """
+        return [self._find_entities(self.tokenize(sentence))
+                for sentence in section]
+
+    def _retrieve_section_evidences(self, statements_tokens, section_index):
+        """Search evidences for a group of statements within the
+         given section.
+
+        :param statements_tokens: list with the tokens of each statement,
+            to be used as queries to look for evidences
+        :param section_index: entities found in each sentence of the CTR
+            section to extract evidences from, as built by `_index_section`
+
+        :return: list with the indexes of those sentences in the section
+            considered as evidences for each statement
+        """
+        return [self._retrieve_statement_evidences(statement_tokens,
+                                                   section_index)
+                for statement_tokens in statements_tokens]
+
+    def _retrieve_statement_evidences(self, statement_tokens, section_index):
         """Search evidences for the given statement within the
          given section.
 
         :param statement_tokens: statement tokens to be used as query to look
             for evidences
-        :param section: CTR section to extract evidences from
+        :param section_index: entities found in each sentence of the CTR
+            section to extract evidences from, as built by `_index_section`
 
         :return: list of indexes of those sentences in the section
             considered as evidences for the given statement
         """
-        statement_ents = []
-        for term in statement_tokens:
-            ids = self.__ont.search(term + '%')
-            if ids:
-                statement_ents.append(ids)
+        statement_ents, statement_matches = \
+            self._find_entities(statement_tokens)
 
-        # flatten list
-        statement_ents = \
-            [item for sublist in statement_ents for item in sublist]
+        if not statement_ents:
+            return []
 
         # compute similarity for each sentence
-        section_evidences = []
-        index = 0
-        for sentence in section:
-            sentence_ents = []
-            for term in self.tokenize(sentence):
-                ids = self.__ont.search(term + '%')
-                if ids:
-                    sentence_ents.append(ids)
-
-            # flatten list
-            sentence_ents = \
-                [item for sublist in sentence_ents for item in sublist]
-
-            common = len(set(statement_ents) & set(sentence_ents))
+        sims = np.zeros(len(section_index))
+        for index, (sentence_ents, sentence_matches) in \
+                enumerate(section_index):
+            # Skip the intersection when the sentence could not get over
+            # the threshold even if it shared all its entities
+            upper_bound = min(len(statement_ents), len(sentence_ents)) \
+                / (statement_matches + sentence_matches)
+            if upper_bound <= self._threshold:
+                continue
+            common = len(statement_ents & sentence_ents)
             if common == 0:
                 continue
-            sim = common / (len(statement_ents) + len(sentence_ents))
-            if sim > self._threshold:
-                section_evidences.append(index)
-            index += 1
+            sims[index] = common / (statement_matches + sentence_matches)
+
+        section_evidences = np.flatnonzero(sims > self._threshold).tolist()
 
         return section_evidences
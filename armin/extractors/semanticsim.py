@@ -18,14 +18,21 @@
 # Authors:
 #     Alberto Pérez García-Plaza <alberto.perez@lsi.uned.es>
 #
-import datetime
-import time
+import hashlib
+import os
+import tempfile
 
-from sentence_transformers import SentenceTransformer, util
+import torch
+from joblib import effective_n_jobs
+from sentence_transformers import SentenceTransformer
 from torch import Tensor
+from tqdm import tqdm
 
+from armin._threading import configure_torch_threads, worker_threads
 from armin.extractors.baseline import Baseline
 
+configure_torch_threads()
+
 # sentences = ["I'm very happy", "I'm happy"]
 #
 # model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
@@ -61,6 +68,16 @@ class PassageRankingSim(Baseline):
             the set of CTR files
         :param threshold: similarity threshold to decide whether a
             sentence is an evidence or not. Defaults to 80
+        :param backend: SentenceTransformer backend running the model,
+            either "torch" (default) or "onnx". The latter requires
+            `optimum` and `onnxruntime`, and is usually faster on CPU
+        :param compile_model: whether to compile the torch model with
+            `torch.compile`. Compiling takes a while, so it pays off on
+            long runs only. Defaults to False
+        :param cache_dir: folder where statement and section embeddings
+            are stored, so later runs on the same dataset, CTRs and model
+            load them instead of encoding everything again. None
+            (default) disables the cache
 
         :raises DatasetError: when the dataset file path does not exist
             or is not valid
@@ -68,98 +85,330 @@ class PassageRankingSim(Baseline):
             valid
         """
 
-    def __init__(self, dataset_path, ctrs_folder_path, threshold=80):
+    # Whether embeddings are L2-normalized when encoded
+    _normalize_embeddings = False
+
+    def __init__(self, dataset_path, ctrs_folder_path, threshold=80,
+                 backend="torch", compile_model=False, cache_dir=None):
         super().__init__(dataset_path, ctrs_folder_path)
 
-        self._threshold = threshold
+        self._dataset_path = dataset_path
+        self._threshold = float(threshold)
+        self._backend = backend
+        self._compile_model = compile_model
+        self._cache_dir = cache_dir
 
         self._init_model()
 
     def _init_model(self):
         print("Creating model...", end='')
-        self._model = SentenceTransformer(
+        self._model = self._load_model(
                 'sentence-transformers/msmarco-distilbert-base-tas-b')
         print("Done!")
 
+    def _load_model(self, model_name):
+        """Load a SentenceTransformer model ready for inference.
+
+        Torch models use PyTorch fused attention (SDPA) instead of
+        the eager implementation, and on GPU they run in half precision,
+        which roughly doubles their throughput with a negligible drift
+        in the embeddings. They are compiled too when `compile_model`
+        is set. ONNX models are exported and optimized by
+        SentenceTransformer itself.
+
+        :param model_name: name or path of the model to load
+
+        :return: the SentenceTransformer model
+        """
+        self._model_name = model_name
+
+        model = None
+        if self._backend == "torch":
+            try:
+                model = SentenceTransformer(
+                        model_name,
+                        backend=self._backend,
+                        model_kwargs={"attn_implementation": "sdpa"})
+            except ValueError:
+                # Not every architecture supports SDPA, use the default
+                # attention implementation for those
+                pass
+        if model is None:
+            model = SentenceTransformer(model_name, backend=self._backend)
+        model.eval()
+        if self._backend == "torch":
+            if torch.cuda.is_available():
+                model.half()
+            if self._compile_model:
+                # Compile the transformer module in place, so its own
+                # forward is the one compiled. Sentences come in batches
+                # of varying lengths, so compile for dynamic shapes
+                # instead of recompiling for every new length
+                model[0].compile(dynamic=True)
+
+        return model
+
+    def _encode(self, sentences, pool=None,
+                show_progress_bar=False) -> Tensor:
+        """Encode a list of sentences in batches.
+
+        Sentences must always be given as a list: SentenceTransformer
+        sorts them by length before batching them, so each batch is
+        padded as little as possible, and restores their order afterwards.
+
+        :param sentences: list of sentences to encode
+        :param pool: optional multi-process pool, as started by
+            `start_multi_process_pool`, to spread the batches over
+        :param show_progress_bar: whether to display the progress of
+            the encoding
+
+        :return: tensor with the embedding of each sentence
+        """
+        return self._model.encode(
+                sentences,
+                batch_size=64,
+                convert_to_tensor=True,
+                show_progress_bar=show_progress_bar,
+                normalize_embeddings=self._normalize_embeddings,
+                pool=pool)
+
+    def _encode_all(self, statements, sections, n_jobs=1):
+        """Encode the statements along with the given CTR sections.
+        Sentences repeated across sections or statements, like the
+        boilerplate of eligibility criteria, are encoded only once.
+        Section embeddings are stored in the section cache.
+
+        :param statements: list of statements to encode
+        :param sections: list of (CTR identifier, section identifier)
+            pairs of the sections to encode
+        :param n_jobs: number of CPU processes to encode with, -1 to use
+            all CPUs. Defaults to 1, which encodes everything within the
+            current process and on the model device
+
+        :return: tensor with the embedding of each statement
+        """
+        # Map each distinct sentence to its row in the embeddings matrix
+        rows = {}
+        st_rows = [rows.setdefault(sent, len(rows)) for sent in statements]
+        sections_rows = []
+        for ctr_id, section_id in sections:
+            section = self._crt_reader.read_section(ctr_id, section_id)
+            sections_rows.append([rows.setdefault(sent, len(rows))
+                                  for sent in section])
+
+        # Dicts keep insertion order, so sentences match their rows
+        sentences = list(rows)
+
+        # Encoding takes most of the time, so show its progress
+        # n_jobs follows joblib conventions, as in Baseline
+        n_jobs = effective_n_jobs(n_jobs)
+        if n_jobs == 1:
+            embeddings = self._encode(sentences, show_progress_bar=True)
+        else:
+            with worker_threads(n_jobs):
+                pool = self._model.start_multi_process_pool(["cpu"]
+                                                            * n_jobs)
+            try:
+                embeddings = self._encode(sentences, pool=pool,
+                                          show_progress_bar=True)
+            finally:
+                self._model.stop_multi_process_pool(pool)
+
+        def gather(indexes):
+            return embeddings[torch.tensor(indexes,
+                                           dtype=torch.long,
+                                           device=embeddings.device)]
+
+        for key, section_rows in zip(sections, sections_rows):
+            self._section_indexes[key] = gather(section_rows)
+
+        return gather(st_rows)
+
+    def _embeddings_cache_path(self):
+        """Path of the file caching the embeddings of this extractor.
+
+        The file name is a hash of everything embeddings depend on: the
+        model and how it runs, the dataset contents and the modification
+        times of the CTR files. Any change on them leads to a new file.
+
+        :return: path of the cache file
+        """
+        key = hashlib.sha256()
+        key.update(repr((self._model_name,
+                         self._backend,
+                         self._normalize_embeddings,
+                         self._model.device.type)).encode())
+
+        with open(self._dataset_path, "rb") as dataset_file:
+            key.update(dataset_file.read())
+
+        ctrs_folder_path = self._crt_reader.ctrs_folder_path
+        for name in sorted(os.listdir(ctrs_folder_path)):
+            stat = os.stat(os.path.join(ctrs_folder_path, name))
+            key.update(("%s:%d:%d\n" % (name,
+                                        stat.st_mtime_ns,
+                                        stat.st_size)).encode())
+
+        return os.path.join(self._cache_dir, key.hexdigest() + ".pt")
+
+    def _load_or_encode_all(self, statements, sections, n_jobs=1):
+        """Same as `_encode_all`, but reading the embeddings from the
+        cache folder when they were stored by a previous run, and storing
+        them otherwise.
+
+        :param statements: list of statements to encode
+        :param sections: list of (CTR identifier, section identifier)
+            pairs of the sections to encode
+        :param n_jobs: number of CPU processes to encode with
+
+        :return: tensor with the embedding of each statement
+        """
+        if self._cache_dir is None:
+            return self._encode_all(statements, sections, n_jobs)
+
+        cache_path = self._embeddings_cache_path()
+        if os.path.exists(cache_path):
+            cached = torch.load(cache_path, map_location=self._model.device)
+            self._section_indexes.update(cached["sections"])
+            return cached["statements"]
+
+        st_embeddings = self._encode_all(statements, sections, n_jobs)
+
+        # Write to a temporary file first, so an interrupted run does
+        # not leave a truncated cache behind. Its name is unique, so
+        # concurrent runs sharing the cache folder do not clash.
+        os.makedirs(self._cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self._cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                torch.save({"statements": st_embeddings,
+                            "sections": {key: self._section_indexes[key]
+                                         for key in sections}},
+                           tmp_file)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        return st_embeddings
+
     def _compute_similarity(self,
-                            st_embedding,
-                            sect_sentence_embedding) -> Tensor:
-        # TODO compute similarity for a whole section at once
-        return util.dot_score(st_embedding, sect_sentence_embedding)
+                            st_embeddings: Tensor,
+                            sect_embeddings: Tensor) -> Tensor:
+        """Score every sentence of a section against a group of
+        statements.
+
+        :param st_embeddings: statement embeddings, of shape (M, D)
+        :param sect_embeddings: embeddings of the section sentences,
+            of shape (N, D)
+
+        :return: tensor of shape (M, N) with the score of each sentence
+            for each statement
+        """
+        return st_embeddings @ sect_embeddings.T
+
+    def _retrieve_section_evidences(self, statements_tokens, section_index):
+        """Not available: sections are scored by `compute_scores`
+        from their embeddings, not searched with BM25 indexes."""
+
+        raise NotImplementedError("use compute_scores instead")
+
+    def _retrieve_group_evidences(self, ctr_id, section_id, entries):
+        """Not available: sections are scored by `compute_scores`
+        from their embeddings, not searched with BM25 indexes."""
 
-    def _retrieve_section_evidences(self, st_embedding, section):
-        """Search evidences for the given statement within the
-         given section.
+        raise NotImplementedError("use compute_scores instead")
 
-        :param st_embedding: statement embedding to be used as query
-        :param section: CTR section to extract evidences from
+    @torch.inference_mode()
+    def compute_scores(self, n_jobs=1):
+        """Score the sentences of the CTR sections each statement in the
+        dataset refers to. Scores do not depend on the threshold, so
+        they can be computed once and thresholded many times with
+        `threshold_scores`.
 
-        :return: list of indexes of those sentences in the section
-            considered as evidences for the given statement
+        :param n_jobs: number of CPU processes used to encode the
+            statements and CTR sections, -1 to use all CPUs. Defaults
+            to 1, which encodes everything within the current process
+            and on the model device
+
+        :return: a dict with the primary and secondary (when applies)
+            scores of each statement, as tensors with the score of each
+            sentence in the corresponding section
         """
-        scores = []
-        for sect_sentence in section:
-            sect_sentence_embedding = \
-                self._model.encode(sect_sentence, convert_to_tensor=True)
-            score: Tensor = self._compute_similarity(st_embedding,
-                                                     sect_sentence_embedding)
-            scores.append(score.item())
+        groups = self._group_by_section()
+
+        # Encode every statement and section in a single batched pass
+        statements = [ps_info["Statement"]
+                      for ps_info in self.dataset.values()]
+        st_embeddings = self._load_or_encode_all(statements,
+                                                 list(groups),
+                                                 n_jobs)
+        st_rows = {uuid: row for row, uuid in enumerate(self.dataset)}
+
+        # Score all the statements referring to a section at once
+        group_scores = {}
+        for (ctr_id, section_id), entries in tqdm(groups.items(),
+                                                  unit="section"):
+            # Filled in by the encoding pass above
+            sect_embeddings = self._section_indexes[ctr_id, section_id]
+            rows = torch.tensor([st_rows[uuid] for uuid, _ in entries],
+                                device=st_embeddings.device)
+            group_scores.update(zip(entries, self._compute_similarity(
+                    st_embeddings[rows],
+                    sect_embeddings)))
+
+        # Rebuild the scores following the dataset order
+        scores = {}
+        for uuid, ps_info in self.dataset.items():
+            scores[uuid] = {
+                "Primary_evidence_index":
+                    group_scores[uuid, "Primary_evidence_index"]
+            }
+            if ps_info["Type"] == "Comparison":
+                scores[uuid]["Secondary_evidence_index"] = \
+                    group_scores[uuid, "Secondary_evidence_index"]
 
-        section_evidences = [i for i in range(len(scores))
-                             if scores[i] > self._threshold]
+        return scores
 
-        return section_evidences
+    def threshold_scores(self, scores, threshold=None):
+        """Select as evidences the sentences scoring over a threshold.
 
-    def retrieve_evidences(self):
-        """Retrieve evidences for each statement in the dataset from the
-        corresponding CTR files and sections.
+        :param scores: sentence scores, as returned by `compute_scores`
+        :param threshold: similarity threshold to decide whether a
+            sentence is an evidence or not. Defaults to the one given
+            to the extractor
 
         :return: a dict with the primary and secondary (when applies)
             evidences retrieved from the CTRs. Evidences are represented
             as a list of indexes of each sentence considered as evidence
             for the given statement.
         """
-        total = len(self.dataset.keys())
-        completed = 0
-        start = time.perf_counter()
-        elapsed = 0
-        results = {}
-        for uuid in self.dataset.keys():
-            ps_info = self.dataset[uuid]
-            st_embedding = self._model.encode(ps_info["Statement"],
-                                              convert_to_tensor=True)
-            primary_section = \
-                self._crt_reader.read_section(ps_info["Primary_id"],
-                                              ps_info["Section_id"])
-
-            primary_evidences = self._retrieve_section_evidences(
-                    st_embedding,
-                    primary_section)
-            results[uuid] = {"Primary_evidence_index": primary_evidences}
-
-            # Repeat for the secondary trial
-            if ps_info["Type"] == "Comparison":
-                secondary_section = self._crt_reader.read_section(
-                        ps_info["Secondary_id"],
-                        ps_info["Section_id"])
-
-                secondary_evidences = self._retrieve_section_evidences(
-                        st_embedding,
-                        secondary_section)
-                results[uuid]["Secondary_evidence_index"] = secondary_evidences
+        if threshold is None:
+            threshold = self._threshold
+        threshold = float(threshold)
+
+        # Scores stay on the model device, so only the indexes of the
+        # evidences found are moved back
+        return {uuid: {key: (sect_scores > threshold).nonzero(
+                                 as_tuple=True)[0].tolist()
+                       for key, sect_scores in st_scores.items()}
+                for uuid, st_scores in scores.items()}
+
+    def retrieve_evidences(self, n_jobs=1):
+        """Retrieve evidences for each statement in the dataset from the
+        corresponding CTR files and sections.
 
-            completed += 1
-            end = time.perf_counter()
-            elapsed = (end - start)
-            estimated = (1 / (completed / total)) * elapsed
-            print(f"\r[{uuid}] Completion: {completed}/{total} "
-                  f"Elapsed: {datetime.timedelta(seconds=round(elapsed))} - "
-                  f"Estimated: {datetime.timedelta(seconds=round(estimated))}",
-                  end='')
+        :param n_jobs: number of CPU processes used to encode the
+            statements and CTR sections, -1 to use all CPUs. Defaults
+            to 1, which encodes everything within the current process
+            and on the model device
 
-        print(f"\rCompletion: {completed}/{total} "
-              f"Elapsed: {datetime.timedelta(seconds=round(elapsed))}")
-        return results
+        :return: a dict with the primary and secondary (when applies)
+            evidences retrieved from the CTRs. Evidences are represented
+            as a list of indexes of each sentence considered as evidence
+            for the given statement.
+        """
+        return self.threshold_scores(self.compute_scores(n_jobs))
 
 
 class SemanticSearch(PassageRankingSim):
@@ -170,6 +419,16 @@ class SemanticSearch(PassageRankingSim):
             the set of CTR files
         :param threshold: similarity threshold to decide whether a
             sentence is an evidence or not. From 0 to 1, defaults to 0.5
+        :param backend: SentenceTransformer backend running the model,
+            either "torch" (default) or "onnx". The latter requires
+            `optimum` and `onnxruntime`, and is usually faster on CPU
+        :param compile_model: whether to compile the torch model with
+            `torch.compile`. Compiling takes a while, so it pays off on
+            long runs only. Defaults to False
+        :param cache_dir: folder where statement and section embeddings
+            are stored, so later runs on the same dataset, CTRs and model
+            load them instead of encoding everything again. None
+            (default) disables the cache
 
         :raises DatasetError: when the dataset file path does not exist
             or is not valid
@@ -177,47 +436,30 @@ class SemanticSearch(PassageRankingSim):
             valid
         """
 
-    def __init__(self, dataset_path, ctrs_folder_path, threshold=.5):
-        super().__init__(dataset_path, ctrs_folder_path, threshold)
+    # Scores are cosine similarities: the dot product of normalized
+    # embeddings, which are normalized only once when encoded
+    _normalize_embeddings = True
+
+    def __init__(self, dataset_path, ctrs_folder_path, threshold=.5,
+                 backend="torch", compile_model=False, cache_dir=None):
+        super().__init__(dataset_path, ctrs_folder_path, threshold,
+                         backend, compile_model, cache_dir)
 
     def _init_model(self):
         print("Creating model...", end='')
         # https://huggingface.co/sentence-transformers/all-MiniLM-L6-v2
-        self._model = SentenceTransformer(
+        self._model = self._load_model(
                 'sentence-transformers/all-MiniLM-L6-v2')
         print("Done!")
 
-    def _compute_similarity(self,
-                            st_embedding,
-                            sect_sentence_embedding) -> Tensor:
-        return util.pytorch_cos_sim(st_embedding, sect_sentence_embedding)
-
 
-class SemanticSearchPubmed(PassageRankingSim):
-    """Semantic Search based evidence extractor.
-
-        :param dataset_path: path of the dataset
-        :param ctrs_folder_path: path to the folder containing
-            the set of CTR files
-        :param threshold: similarity threshold to decide whether a
-            sentence is an evidence or not. From 0 to 1, defaults to 0.5
-
-        :raises DatasetError: when the dataset file path does not exist
-            or is not valid
-        :raises CTRError: when the CTRs folder does not exist or is not
-            valid
-        """
-
-    def __init__(self, dataset_path, ctrs_folder_path, threshold=.5):
-        super().__init__(dataset_path, ctrs_folder_path, threshold)
+class SemanticSearchPubmed(SemanticSearch):
+    """Semantic Search based evidence extractor, with a model tuned on
+    PubMed abstracts. Takes the same parameters as `SemanticSearch`.
+    """
 
     def _init_model(self):
         print("Creating model...", end='')
-        self._model = SentenceTransformer(
+        self._model = self._load_model(
                 'tavakolih/all-MiniLM-L6-v2-pubmed-full')
         print("Done!")
-
-    def _compute_similarity(self,
-                            st_embedding,
-                            sect_sentence_embedding) -> Tensor:
-        return util.pytorch_cos_sim(st_embedding, sect_sentence_embedding)
\ No newline at end of file
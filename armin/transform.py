@@ -18,11 +18,14 @@
 # Authors:
 #     Alberto Pérez García-Plaza <alberto.perez@lsi.uned.es>
 #
-import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
 
 from .errors import DatasetError
-from .extractors import CTRReader
+from .extractors.baseline import CTRReader
+from .utils import load_json
 
 
 class JSONTransformer:
@@ -49,25 +52,26 @@ class JSONTransformer:
         self._crt_reader = CTRReader(ctrs_folder_path)
 
         # Load dataset
-        with open(dataset_path) as dataset_file:
-            self.dataset = json.load(dataset_file)
+        self.dataset = load_json(dataset_path)
 
-    def transform(self, out_file):
+    def transform(self, out_file, n_threads=8):
         """Transforms the dataset into a set of pairs of sentences
         (statement, evidence) and their relationship (entailment,
         contradiction, neutral).
 
+        Pairs are written in JSON Lines format, one JSON object per
+        line. CTR sections are read in the background while the pairs
+        of previous statements are written.
+
         :param out_file: output file path
+        :param n_threads: number of threads reading CTR sections
         """
-        with open(out_file, "w") as out:
-            out.write("[\n")
-            for uuid in self.dataset.keys():
-                # get premise-statement info
-                ps_info = self.dataset[uuid]
-
-                primary_section = \
-                    self._crt_reader.read_section(ps_info["Primary_id"],
-                                                  ps_info["Section_id"])
+        with open(out_file, "wb") as out, \
+                ThreadPoolExecutor(max_workers=n_threads) as executor:
+            sections = executor.map(self._read_sections,
+                                    self.dataset.values())
+            for (uuid, ps_info), (primary_section, secondary_section) in \
+                    zip(self.dataset.items(), sections):
                 self._write_pairs(uuid,
                                   ps_info["Type"],
                                   ps_info["Section_id"],
@@ -78,9 +82,6 @@ class JSONTransformer:
                                   out)
 
                 if ps_info["Type"] == "Comparison":
-                    secondary_section = \
-                        self._crt_reader.read_section(ps_info["Secondary_id"],
-                                                      ps_info["Section_id"])
                     self._write_pairs(uuid,
                                       ps_info["Type"],
                                       ps_info["Section_id"],
@@ -89,7 +90,25 @@ class JSONTransformer:
                                       secondary_section,
                                       ps_info["Label"],
                                       out)
-            out.write("]\n")
+
+    def _read_sections(self, ps_info):
+        """Reads the CTR sections a Premise-Statement pair refers to.
+
+        :param ps_info: Premise-Statement pair, as found in the dataset
+
+        :return: a tuple with the primary and secondary sections, the
+            latter being None unless the pair is a Comparison
+        """
+        primary_section = \
+            self._crt_reader.read_section(ps_info["Primary_id"],
+                                          ps_info["Section_id"])
+        secondary_section = None
+        if ps_info["Type"] == "Comparison":
+            secondary_section = \
+                self._crt_reader.read_section(ps_info["Secondary_id"],
+                                              ps_info["Section_id"])
+
+        return primary_section, secondary_section
 
     @staticmethod
     def _write_pairs(uuid, _type, section_id,
@@ -109,10 +128,11 @@ class JSONTransformer:
         :param sentences: list of sentences to write pairs from
         :param label: relationship between the statement and the
             evidence (entailment | contradiction)
-        :param out: output file
+        :param out: output file, opened in binary mode
         """
-        sentence_number = 0
-        for sent in sentences:
+        evidence_indexes = frozenset(evidence_indexes)
+        lines = []
+        for sentence_number, sent in enumerate(sentences):
             # For each sentence, mark it as neutral if its index is not
             # included in the evidence indexes set, use `label` value otherwise
             #
@@ -122,7 +142,7 @@ class JSONTransformer:
             else:
                 relationship = "neutral"
 
-            out.write(json.dumps({
+            lines.append(orjson.dumps({
                 "uuid": uuid,
                 "section_id": section_id,
                 "type": _type,
@@ -130,6 +150,6 @@ class JSONTransformer:
                 "statement": statement,
                 "evidence": sent
 
-            }) + ",\n")
+            }) + b"\n")
 
-            sentence_number += 1
+        out.writelines(lines)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 Alberto Pérez García-Plaza
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Alberto Pérez García-Plaza <alberto.perez@lsi.uned.es>
+#
+import orjson
+
+
+def load_json(path):
+    """Loads a JSON file. Datasets, results and CTR files are all read
+    through this function.
+
+    :param path: path of the JSON file
+
+    :return: the decoded JSON document
+    """
+    with open(path, "rb") as json_file:
+        return orjson.loads(json_file.read())
@@ -68,55 +68,49 @@ def run_ontobio():
     print('Ontobio recall_score:{:f}'.format(metrics["recall"]))
 
 
-def run_passage_ranking(threshold: float) -> dict:
-    prsim = PassageRankingSim(DATASET_PATH,
-                              "./training_data/CT json",
-                              threshold=threshold)
-    evidences = prsim.retrieve_evidences()
-    # print(evidences)
-    # print("Writing results to " + PASSAGE_RANKING_RESULTS_PATH)
-    with open(PASSAGE_RANKING_RESULTS_PATH, 'w') as jsonFile:
-        jsonFile.write(json.dumps(evidences, indent=4))
-    # Evaluate results
+def threshold_runner(extractor: PassageRankingSim,
+                     results_path: str) -> Callable[[float], dict]:
+    """Build a function running the given extractor with a threshold.
+
+    Sentence scores do not depend on the threshold, so they are
+    computed only once and reused for every threshold tested.
+    """
+
+    scores = extractor.compute_scores()
     evaluator = NLI4CTEvaluator(DATASET_PATH)
-    _metrics = evaluator.evaluate(PASSAGE_RANKING_RESULTS_PATH)
 
-    return _metrics
+    def run(threshold: float) -> dict:
+        evidences = extractor.threshold_scores(scores, threshold)
+        with open(results_path, 'w') as jsonFile:
+            jsonFile.write(json.dumps(evidences, indent=4))
+        # Evaluate results
+        return evaluator.evaluate(results_path)
 
+    return run
 
-def run_semantic_search(threshold: float) -> dict:
-    """Run Semantic Search experiment."""
 
-    ssim = SemanticSearch(DATASET_PATH,
-                          "./training_data/CT json",
-                          threshold=threshold)
-    evidences = ssim.retrieve_evidences()
-    # print(evidences)
-    # print("Writing results to " + SEMANTIC_SEARCH_RESULTS_PATH)
-    with open(SEMANTIC_SEARCH_RESULTS_PATH, 'w') as jsonFile:
-        jsonFile.write(json.dumps(evidences, indent=4))
-    # Evaluate results
-    evaluator = NLI4CTEvaluator(DATASET_PATH)
-    _metrics = evaluator.evaluate(SEMANTIC_SEARCH_RESULTS_PATH)
+def run_passage_ranking() -> Callable[[float], dict]:
+    """Prepare Passage Ranking experiment."""
 
-    return _metrics
+    prsim = PassageRankingSim(DATASET_PATH, "./training_data/CT json")
 
+    return threshold_runner(prsim, PASSAGE_RANKING_RESULTS_PATH)
 
-def run_semantic_search_pubmed(threshold: float) -> dict:
-    """Run Semantic Search experiment."""
 
-    ssimpm = SemanticSearchPubmed(DATASET_PATH,
-                                  "./training_data/CT json",
-                                  threshold=threshold)
-    evidences = ssimpm.retrieve_evidences()
+def run_semantic_search() -> Callable[[float], dict]:
+    """Prepare Semantic Search experiment."""
 
-    with open(SEMANTIC_SEARCH_PM_RESULTS_PATH, 'w') as jsonFile:
-        jsonFile.write(json.dumps(evidences, indent=4))
-    # Evaluate results
-    evaluator = NLI4CTEvaluator(DATASET_PATH)
-    _metrics = evaluator.evaluate(SEMANTIC_SEARCH_PM_RESULTS_PATH)
+    ssim = SemanticSearch(DATASET_PATH, "./training_data/CT json")
+
+    return threshold_runner(ssim, SEMANTIC_SEARCH_RESULTS_PATH)
+
+
+def run_semantic_search_pubmed() -> Callable[[float], dict]:
+    """Prepare Semantic Search Pubmed experiment."""
+
+    ssimpm = SemanticSearchPubmed(DATASET_PATH, "./training_data/CT json")
 
-    return _metrics
+    return threshold_runner(ssimpm, SEMANTIC_SEARCH_PM_RESULTS_PATH)
 
 
 def find_best_threshold(extractor: Callable[[float], dict],
@@ -156,7 +150,7 @@ if __name__ == '__main__':
     # print("Finding best threshold...")
     print("\nExecuting Passage Ranking experiment\n")
     print("Finding best threshold...")
-    best_t = find_best_threshold(run_passage_ranking,
+    best_t = find_best_threshold(run_passage_ranking(),
                                  10, 120, 10)
     print("Best threshold: " + str(best_t))
 
@@ -164,12 +158,12 @@ if __name__ == '__main__':
     # Present the thresholds based on f1 results
     # print("\nExecuting Semantic Search experiment\n")
     # print("Finding best threshold...")
-    # best_t = find_best_threshold(run_semantic_search,
+    # best_t = find_best_threshold(run_semantic_search(),
     #                              0.1, 0.9, 0.1)
     # print("Best threshold: " + str(best_t))
 
     print("\nExecuting Semantic Search Pubmed experiment\n")
     print("Finding best threshold...")
-    best_t = find_best_threshold(run_semantic_search_pubmed,
+    best_t = find_best_threshold(run_semantic_search_pubmed(),
                                  0.1, 0.9, 0.1)
     print("Best threshold: " + str(best_t))
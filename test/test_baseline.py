@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 Alberto Pérez García-Plaza
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Alberto Pérez García-Plaza <alberto.perez@lsi.uned.es>
+#
+
+import os
+import sys
+import unittest
+
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+# Make sure we use our code and not any other could we have installed
+sys.path.insert(0, '..')
+
+from armin.extractors.baseline import Baseline, CTRReader
+
+
+class TestBaseline(unittest.TestCase):
+
+    def setUp(self):
+        self.__data_dir = \
+            os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                         'data')
+        self.__ctrs_dir = os.path.join(self.__data_dir, 'ctrs')
+
+    def __reference_evidences(self, baseline, dataset):
+        """Evidences as the BM25Okapi scoring from rank_bm25 finds them"""
+
+        ctr_reader = CTRReader(self.__ctrs_dir)
+        evidences = {}
+        for uuid, entry in dataset.items():
+            statement_tokens = baseline.tokenize(entry["Statement"])
+            evidences[uuid] = {}
+            for ctr_key, evidence_key in (
+                    ("Primary_id", "Primary_evidence_index"),
+                    ("Secondary_id", "Secondary_evidence_index")):
+                if ctr_key not in entry:
+                    continue
+                section = ctr_reader.read_section(
+                    entry[ctr_key], entry["Section_id"])
+                bm25 = BM25Okapi([baseline.tokenize(sentence)
+                                  for sentence in section])
+                scores = bm25.get_scores(statement_tokens)
+                evidences[uuid][evidence_key] = \
+                    np.flatnonzero(scores > 1).tolist()
+        return evidences
+
+    def __assert_matches_reference(self, dataset_file):
+        baseline = Baseline(os.path.join(self.__data_dir, dataset_file),
+                            self.__ctrs_dir)
+        expected = self.__reference_evidences(baseline, baseline.dataset)
+
+        self.assertDictEqual(baseline.retrieve_evidences(), expected)
+        self.assertDictEqual(baseline.retrieve_evidences(n_jobs=2), expected)
+
+    def test_retrieve_evidences(self):
+        self.__assert_matches_reference('dataset.json')
+
+    def test_retrieve_evidences_frequent_tokens(self):
+        """Tokens in more than half the sentences get a negative IDF,
+        which BM25Okapi floors to a small positive value"""
+
+        baseline = Baseline(
+            os.path.join(self.__data_dir, 'dataset_adverse_events.json'),
+            self.__ctrs_dir)
+        section = CTRReader(self.__ctrs_dir).read_section('NCT00000003',
+                                                          'Adverse Events')
+        tokenized = [baseline.tokenize(sentence) for sentence in section]
+        nausea = sum('nausea' in tokens for tokens in tokenized)
+        self.assertGreater(nausea, len(section) / 2)
+
+        self.__assert_matches_reference('dataset_adverse_events.json')
+
+
+if __name__ == "__main__":
+    unittest.main()
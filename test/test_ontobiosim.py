@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 Alberto Pérez García-Plaza
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Alberto Pérez García-Plaza <alberto.perez@lsi.uned.es>
+#
+
+import os
+import sys
+import types
+import unittest
+import unittest.mock
+
+# Make sure we use our code and not any other could we have installed
+sys.path.insert(0, '..')
+
+class MockOntology:
+    """Ontology with a handful of labelled nodes"""
+
+    LABELS = {
+        "GO:0000001": "breast cancer",
+        "GO:0000002": "women",
+        "GO:0000003": None
+    }
+
+    def nodes(self):
+        return list(self.LABELS)
+
+    def label(self, node_id):
+        return self.LABELS[node_id]
+
+
+class MockOntologyFactory:
+
+    def create(self, name):
+        return MockOntology()
+
+
+class TestOntobioSim(unittest.TestCase):
+
+    def setUp(self):
+        # Stub ontobio so the extractor can be imported without it
+        ontobio = types.ModuleType('ontobio')
+        ontobio.OntologyFactory = MockOntologyFactory
+        modules = unittest.mock.patch.dict(sys.modules, {'ontobio': ontobio})
+        modules.start()
+        self.addCleanup(modules.stop)
+
+        data_dir = \
+            os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                         'data')
+        self.__dataset_path = os.path.join(data_dir, 'dataset.json')
+        self.__ctrs_path = os.path.join(data_dir, 'ctrs')
+
+    @unittest.mock.patch('armin.extractors.ontobiosim.OntologyFactory',
+                         MockOntologyFactory)
+    def test_evidence_indexes(self):
+        """Test sentences sharing no entities with the statement do not
+        shift the indexes of the evidences after them"""
+
+        from armin.extractors.ontobiosim import OntobioSim
+
+        ob_sim = OntobioSim(self.__dataset_path, self.__ctrs_path, 0.2)
+        evidences = ob_sim.retrieve_evidences()
+
+        # The first sentence of both sections has no entities
+        self.assertEqual(evidences["st-comparison"],
+                         {
+                             "Primary_evidence_index": [1],
+                             "Secondary_evidence_index": [1]
+                         })
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 Alberto Pérez García-Plaza
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Alberto Pérez García-Plaza <alberto.perez@lsi.uned.es>
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+# Make sure we use our code and not any other could we have installed
+sys.path.insert(0, '..')
+
+import torch
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+import armin.extractors.semanticsim as semanticsim
+from armin.extractors.semanticsim import PassageRankingSim
+
+
+def build_tiny_model(model_dir):
+    """Save a tiny random BERT model, so tests do not need to
+    download any model"""
+
+    words = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    words += ("patients treatment arm response placebo group women "
+              "breast cancer age years inclusion criteria men").split()
+    vocab_path = os.path.join(model_dir, "vocab.txt")
+    with open(vocab_path, "w") as vocab_file:
+        vocab_file.write("\n".join(words))
+
+    config = BertConfig(vocab_size=len(words),
+                        hidden_size=16,
+                        num_hidden_layers=1,
+                        num_attention_heads=2,
+                        intermediate_size=32,
+                        max_position_embeddings=64)
+    torch.manual_seed(0)
+    BertModel(config).save_pretrained(model_dir)
+    BertTokenizerFast(vocab_file=vocab_path).save_pretrained(model_dir)
+
+
+class TestPassageRankingSim(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.__model_dir = tempfile.mkdtemp()
+        build_tiny_model(cls.__model_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.__model_dir)
+
+    def setUp(self):
+        data_dir = \
+            os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                         'data')
+        self.__dataset_path = os.path.join(data_dir, 'dataset.json')
+        self.__ctrs_path = os.path.join(data_dir, 'ctrs')
+
+        # Whatever the model name, load the tiny model
+        sentence_transformer = semanticsim.SentenceTransformer
+        model_dir = self.__model_dir
+
+        def load_tiny_model(model_name, *args, **kwargs):
+            return sentence_transformer(model_dir, *args, **kwargs)
+
+        patcher = unittest.mock.patch.object(semanticsim,
+                                             'SentenceTransformer',
+                                             load_tiny_model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_threshold_scores(self):
+        """Test scores are thresholded into lists of evidence indexes"""
+
+        prsim = PassageRankingSim(self.__dataset_path,
+                                  self.__ctrs_path,
+                                  threshold=0.4)
+        scores = {
+            "st-single": {
+                "Primary_evidence_index": torch.tensor([0.1, 0.9, 0.5])
+            },
+            "st-comparison": {
+                "Primary_evidence_index": torch.tensor([0.4, 0.2]),
+                "Secondary_evidence_index": torch.tensor([])
+            }
+        }
+
+        expected = {
+            "st-single": {"Primary_evidence_index": [1, 2]},
+            "st-comparison": {
+                "Primary_evidence_index": [],
+                "Secondary_evidence_index": []
+            }
+        }
+        self.assertEqual(prsim.threshold_scores(scores), expected)
+
+        expected = {
+            "st-single": {"Primary_evidence_index": [1]},
+            "st-comparison": {
+                "Primary_evidence_index": [],
+                "Secondary_evidence_index": []
+            }
+        }
+        self.assertEqual(prsim.threshold_scores(scores, 0.5), expected)
+
+    def test_compute_scores_once(self):
+        """Test thresholding computed scores matches retrieving
+        evidences with the same threshold"""
+
+        prsim = PassageRankingSim(self.__dataset_path,
+                                  self.__ctrs_path)
+        scores = prsim.compute_scores()
+
+        self.assertEqual(prsim.threshold_scores(scores),
+                         prsim.retrieve_evidences())
+
+        evidences = prsim.threshold_scores(scores, float("-inf"))
+        self.assertEqual(evidences,
+                         {
+                             "st-single": {
+                                 "Primary_evidence_index": [0, 1, 2]
+                             },
+                             "st-comparison": {
+                                 "Primary_evidence_index": [0, 1, 2],
+                                 "Secondary_evidence_index": [0, 1]
+                             }
+                         })
+
+    def test_compute_scores_pool(self):
+        """Test encoding with a pool of processes gives the same
+        scores as encoding within the current process"""
+
+        prsim = PassageRankingSim(self.__dataset_path,
+                                  self.__ctrs_path)
+        scores = prsim.compute_scores()
+
+        prsim = PassageRankingSim(self.__dataset_path,
+                                  self.__ctrs_path)
+        pool_scores = prsim.compute_scores(n_jobs=2)
+
+        self.assertEqual(pool_scores.keys(), scores.keys())
+        for uuid, st_scores in scores.items():
+            self.assertEqual(pool_scores[uuid].keys(), st_scores.keys())
+            for key, sect_scores in st_scores.items():
+                torch.testing.assert_close(pool_scores[uuid][key].cpu(),
+                                           sect_scores.cpu())
+
+    def test_embeddings_cache(self):
+        """Test a second run reads the embeddings from the cache folder
+        and changes on the CTRs lead to a new cache file"""
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        ctrs_path = os.path.join(tmp_dir, 'ctrs')
+        shutil.copytree(self.__ctrs_path, ctrs_path)
+        cache_dir = os.path.join(tmp_dir, 'cache')
+
+        prsim = PassageRankingSim(self.__dataset_path, ctrs_path,
+                                  threshold=0.0, cache_dir=cache_dir)
+        scores = prsim.compute_scores()
+        evidences = prsim.threshold_scores(scores)
+        cache_path = prsim._embeddings_cache_path()
+        self.assertEqual(os.listdir(cache_dir),
+                         [os.path.basename(cache_path)])
+
+        prsim = PassageRankingSim(self.__dataset_path, ctrs_path,
+                                  threshold=0.0, cache_dir=cache_dir)
+        with unittest.mock.patch.object(PassageRankingSim,
+                                        '_encode_all') as encode_all:
+            cached_scores = prsim.compute_scores()
+        encode_all.assert_not_called()
+
+        self.assertEqual(prsim.threshold_scores(cached_scores), evidences)
+        for uuid, st_scores in scores.items():
+            for key, sect_scores in st_scores.items():
+                self.assertTrue(torch.equal(cached_scores[uuid][key],
+                                            sect_scores))
+
+        ctr_path = os.path.join(ctrs_path, 'NCT00000001.json')
+        stat = os.stat(ctr_path)
+        os.utime(ctr_path, ns=(stat.st_atime_ns,
+                               stat.st_mtime_ns + 1_000_000_000))
+        self.assertNotEqual(prsim._embeddings_cache_path(), cache_path)
+
+    def test_attention_fallback(self):
+        """Test models with no SDPA support use the default attention"""
+
+        sentence_transformer = semanticsim.SentenceTransformer
+
+        def load_model_without_sdpa(model_name, *args, **kwargs):
+            model_kwargs = kwargs.get("model_kwargs") or {}
+            if model_kwargs.get("attn_implementation") == "sdpa":
+                raise ValueError("SDPA is not supported")
+            return sentence_transformer(model_name, *args, **kwargs)
+
+        with unittest.mock.patch.object(semanticsim,
+                                        'SentenceTransformer',
+                                        load_model_without_sdpa):
+            prsim = PassageRankingSim(self.__dataset_path,
+                                      self.__ctrs_path)
+
+        self.assertEqual(set(prsim.retrieve_evidences()),
+                         {"st-single", "st-comparison"})
+
+    def test_compile_model(self):
+        """Test the model run by the extractor is actually compiled"""
+
+        prsim = PassageRankingSim(self.__dataset_path,
+                                  self.__ctrs_path,
+                                  compile_model=True)
+        evidences = prsim.retrieve_evidences()
+
+        # Module.compile() sets the compiled forward the module runs
+        self.assertIsNotNone(prsim._model[0]._compiled_call_impl)
+        self.assertEqual(set(evidences), {"st-single", "st-comparison"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 Alberto Pérez García-Plaza
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Alberto Pérez García-Plaza <alberto.perez@lsi.uned.es>
+#
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Make sure we use our code and not any other could we have installed
+sys.path.insert(0, '..')
+
+from armin.transform import JSONTransformer
+
+
+class TestJSONTransformer(unittest.TestCase):
+
+    def setUp(self):
+        data_dir = \
+            os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                         'data')
+        self.__dataset_path = os.path.join(data_dir, 'dataset.json')
+        self.__ctrs_path = os.path.join(data_dir, 'ctrs')
+
+        self.__tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.__tmp_dir)
+
+    def test_transform(self):
+        """Test pairs are written in JSON Lines format"""
+
+        out_path = os.path.join(self.__tmp_dir, 'sentences.jsonl')
+        json_transformer = JSONTransformer(self.__dataset_path,
+                                           self.__ctrs_path)
+        json_transformer.transform(out_path)
+
+        with open(out_path, encoding='utf-8') as out_file:
+            lines = out_file.read().splitlines()
+
+        # One pair per sentence of each section: 3 for the single
+        # statement, 3 + 2 for the comparison one
+        self.assertEqual(len(lines), 8)
+        pairs = [json.loads(line) for line in lines]
+
+        self.assertEqual(pairs[0],
+                         {
+                             "uuid": "st-single",
+                             "section_id": "Results",
+                             "type": "Single",
+                             "target": "entailment",
+                             "statement": "Patients in the treatment arm "
+                                          "had a better response than the "
+                                          "placebo group",
+                             "evidence": "Response rate in the treatment "
+                                         "arm: 45%"
+                         })
+        self.assertEqual([pair["target"] for pair in pairs],
+                         ["entailment", "neutral", "entailment",
+                          "neutral", "contradiction", "neutral",
+                          "contradiction", "neutral"])
+        self.assertEqual([pair["evidence"] for pair in pairs[3:]],
+                         ["Inclusion Criteria:",
+                          "Women with breast cancer",
+                          "Age over 18 years",
+                          "Inclusion Criteria:",
+                          "Men with prostate cancer"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -27,7 +27,7 @@ DATASET_PATH = "./training_data/train.json"
 
 def transform_json():
     json_transformer = JSONTransformer(DATASET_PATH, "./training_data/CT json")
-    json_transformer.transform("./sentences.json")
+    json_transformer.transform("./sentences.jsonl")
 
 
 if __name__ == '__main__':